@@ -1,12 +1,20 @@
-import os, csv, io, uuid
+import os, csv, io, uuid, time, asyncio, secrets, logging
 from datetime import datetime, timezone, timedelta
 from typing import Optional
 
-from fastapi import FastAPI, HTTPException, Request, Query
+try:
+    # uvicorn picks uvloop itself; this covers other runners (gunicorn workers, scripts)
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
+from fastapi import Depends, FastAPI, Header, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 
-from sqlalchemy import func, text, String, Integer, DateTime, Text, ForeignKey, select
+from sqlalchemy import and_, case, event, exists, func, text, String, Integer, DateTime, Text, ForeignKey, Index, bindparam, insert, lambda_stmt, select, update
+from sqlalchemy.dialects.postgresql import UUID as PG_UUID
 from sqlalchemy.orm import Mapped, mapped_column, declarative_base
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 
@@ -18,12 +26,68 @@ if DATABASE_URL.startswith("postgresql://"):
 CORS_ORIGINS = os.getenv("CORS_ORIGINS", "*")
 RUN_MIGRATIONS = os.getenv("RUN_MIGRATIONS","1") == "1"
 
-engine = create_async_engine(DATABASE_URL, echo=False, pool_pre_ping=True)
+# asyncpg keeps its own keepalive, so skip the per-checkout ping and size the pool for bursts
+_ENGINE_KW = dict(pool_size=20, max_overflow=20, pool_recycle=1800, pool_pre_ping=False) if DATABASE_URL.startswith("postgresql") else dict(pool_pre_ping=True)
+engine = create_async_engine(DATABASE_URL, echo=False, **_ENGINE_KW)
+
+if DATABASE_URL.startswith("sqlite"):
+    @event.listens_for(engine.sync_engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, _record):
+        # WAL lets readers run during writes; NORMAL sync skips the fsync per commit
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.execute("PRAGMA cache_size=-65536")
+        cur.close()
 SessionLocal = async_sessionmaker(engine, expire_on_commit=False)
 Base = declarative_base()
 
+# Raw asyncpg pool for hot read paths (Postgres only); writes stay on the ORM
+pg_pool = None
+
+log = logging.getLogger("foody")
+
 def now_utc(): return datetime.now(timezone.utc)
 
+# --- In-process TTL cache (per worker) ---
+class _TTLCache:
+    def __init__(self, ttl: float, maxsize: int = 10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: dict = {}
+
+    def get(self, key):
+        hit = self._data.get(key)
+        if hit is None: return None
+        value, deadline = hit
+        if deadline <= time.monotonic():
+            self._data.pop(key, None)
+            return None
+        return value
+
+    def set(self, key, value):
+        # re-insert so dict order stays oldest-first
+        self._data.pop(key, None)
+        if len(self._data) >= self.maxsize: self._evict()
+        self._data[key] = (value, time.monotonic() + self.ttl)
+
+    def _evict(self):
+        now = time.monotonic()
+        for k in [k for k, (_, deadline) in self._data.items() if deadline <= now]:
+            del self._data[k]
+        if len(self._data) >= self.maxsize:
+            del self._data[next(iter(self._data))]
+
+    def clear(self): self._data.clear()
+
+# restaurant_id -> api_key; keys are never rotated in place, so a short TTL is safe
+_AUTH_CACHE = _TTLCache(ttl=60)
+# public listing JSON bytes, keyed by (restaurant_id, limit); dropped on every offer write
+_OFFERS_CACHE = _TTLCache(ttl=10, maxsize=1000)
+# reservation code -> QR PNG bytes, rendered at reserve time; lives as long as a reservation
+_QR_CACHE = _TTLCache(ttl=1800, maxsize=5000)
+
 def _parse_client_datetime(s: str) -> datetime:
     # Accept 'YYYY-MM-DDTHH:MM' (naive, local) or full ISO; convert to UTC
     try:
@@ -36,9 +100,19 @@ def _parse_client_datetime(s: str) -> datetime:
 
 
 # --- Models ---
+# Offer ids are uuid4 strings: native UUID on Postgres, plain text elsewhere
+_OfferId = String().with_variant(PG_UUID(as_uuid=False), "postgresql")
+
+def _is_uuid(s: str) -> bool:
+    # canonical form only: uuid.UUID() also takes braces/urn:uuid: that Postgres rejects
+    try:
+        return str(uuid.UUID(s)) == s.lower()
+    except ValueError:
+        return False
+
 class FoodyRestaurant(Base):
     __tablename__ = "foody_restaurants"
-    id: Mapped[str] = mapped_column(String, primary_key=True, default=lambda: "RID_" + uuid.uuid4().hex[:8])
+    id: Mapped[str] = mapped_column(String, primary_key=True, default=lambda: "RID_" + secrets.token_hex(4))
     title: Mapped[str] = mapped_column(String(200))
     phone: Mapped[Optional[str]] = mapped_column(String(50), nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=now_utc)
@@ -50,7 +124,7 @@ class FoodyApiKey(Base):
 
 class FoodyOffer(Base):
     __tablename__ = "foody_offers"
-    id: Mapped[str] = mapped_column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    id: Mapped[str] = mapped_column(_OfferId, primary_key=True, default=lambda: str(uuid.uuid4()))
     restaurant_id: Mapped[str] = mapped_column(String, ForeignKey("foody_restaurants.id"), index=True)
     title: Mapped[str] = mapped_column(String(200))
     description: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
@@ -61,10 +135,19 @@ class FoodyOffer(Base):
     expires_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
     archived_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=now_utc)
+    __table_args__ = (Index("ix_offers_rid_archived_expires", "restaurant_id", "archived_at", "expires_at"),)
+
+# Partial indexes for the active merchant view and the public listing
+Index("ix_offers_rid_created_active", FoodyOffer.restaurant_id, FoodyOffer.created_at.desc(),
+      postgresql_where=FoodyOffer.archived_at.is_(None), sqlite_where=FoodyOffer.archived_at.is_(None))
+Index("ix_offers_expires_live", FoodyOffer.expires_at,
+      postgresql_where=and_(FoodyOffer.archived_at.is_(None), FoodyOffer.qty_left>0),
+      sqlite_where=and_(FoodyOffer.archived_at.is_(None), FoodyOffer.qty_left>0))
+
 class FoodyReservation(Base):
     __tablename__ = "foody_reservations"
-    id: Mapped[str] = mapped_column(String, primary_key=True, default=lambda: "RSV_" + uuid.uuid4().hex[:10])
-    offer_id: Mapped[str] = mapped_column(String, ForeignKey("foody_offers.id"), index=True)
+    id: Mapped[str] = mapped_column(String, primary_key=True, default=lambda: "RSV_" + secrets.token_hex(5))
+    offer_id: Mapped[str] = mapped_column(_OfferId, ForeignKey("foody_offers.id"), index=True)
     restaurant_id: Mapped[str] = mapped_column(String, ForeignKey("foody_restaurants.id"), index=True)
     code: Mapped[str] = mapped_column(String, unique=True, index=True)
     status: Mapped[str] = mapped_column(String, default="reserved")
@@ -73,10 +156,12 @@ class FoodyReservation(Base):
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=now_utc)
     redeemed_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
     expires_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    __table_args__ = (Index("ix_rsv_rid_status", "restaurant_id", "status"),)
 
 
 # --- App ---
-app = FastAPI(title="Foody Backend")
+# orjson encodes datetimes natively, so handlers return them as-is
+app = FastAPI(title="Foody Backend", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -98,7 +183,11 @@ async def _auto_migrate(conn):
         "ALTER TABLE foody_offers ADD COLUMN IF NOT EXISTS qty_left INTEGER",
         "ALTER TABLE foody_offers ADD COLUMN IF NOT EXISTS archived_at TIMESTAMPTZ",
         "ALTER TABLE foody_offers ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ",
-        "CREATE TABLE IF NOT EXISTS foody_reservations (id VARCHAR PRIMARY KEY, offer_id VARCHAR, restaurant_id VARCHAR, code VARCHAR UNIQUE, status VARCHAR, qty INTEGER, price_cents_effective INTEGER, created_at TIMESTAMPTZ, redeemed_at TIMESTAMPTZ, expires_at TIMESTAMPTZ)"
+        "CREATE TABLE IF NOT EXISTS foody_reservations (id VARCHAR PRIMARY KEY, offer_id VARCHAR, restaurant_id VARCHAR, code VARCHAR UNIQUE, status VARCHAR, qty INTEGER, price_cents_effective INTEGER, created_at TIMESTAMPTZ, redeemed_at TIMESTAMPTZ, expires_at TIMESTAMPTZ)",
+        "CREATE INDEX IF NOT EXISTS ix_rsv_rid_status ON foody_reservations (restaurant_id, status)",
+        "CREATE INDEX IF NOT EXISTS ix_offers_rid_archived_expires ON foody_offers (restaurant_id, archived_at, expires_at)",
+        "CREATE INDEX IF NOT EXISTS ix_offers_rid_created_active ON foody_offers (restaurant_id, created_at DESC) WHERE archived_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS ix_offers_expires_live ON foody_offers (expires_at) WHERE archived_at IS NULL AND qty_left > 0",
     ]
     for s in stmts:
         try:
@@ -106,115 +195,235 @@ async def _auto_migrate(conn):
         except Exception:
             pass
     try:
-        await conn.execute(text("UPDATE foody_offers SET qty_total=COALESCE(qty_total,1)"))
-        await conn.execute(text("UPDATE foody_offers SET qty_left=COALESCE(qty_left,1)"))
+        # backfill once; already-migrated tables only pay a read-only probe, not a rewrite
+        pending = (await conn.execute(text("SELECT 1 FROM foody_offers WHERE qty_total IS NULL OR qty_left IS NULL LIMIT 1"))).scalar()
+        if pending:
+            await conn.execute(text("UPDATE foody_offers SET qty_total=COALESCE(qty_total,1), qty_left=COALESCE(qty_left,1) WHERE qty_total IS NULL OR qty_left IS NULL"))
     except Exception:
         pass
-    return
- {"ok": True}
+
+async def _migrate_offer_ids_to_uuid(conn):
+    # The model binds offer ids as uuid; running against VARCHAR columns would break every lookup,
+    # so a failed retype aborts startup instead of being swallowed like the other migrations.
+    kind = (await conn.execute(text("SELECT data_type FROM information_schema.columns WHERE table_schema=current_schema() AND table_name='foody_offers' AND column_name='id'"))).scalar()
+    if kind is None or kind == "uuid": return
+    try:
+        async with conn.begin_nested():
+            await conn.execute(text("ALTER TABLE foody_reservations DROP CONSTRAINT IF EXISTS foody_reservations_offer_id_fkey"))
+            await conn.execute(text("ALTER TABLE foody_offers ALTER COLUMN id TYPE uuid USING id::uuid"))
+            await conn.execute(text("ALTER TABLE foody_reservations ALTER COLUMN offer_id TYPE uuid USING offer_id::uuid"))
+    except Exception:
+        log.exception("offer id uuid migration failed")
+        raise
+    try:
+        async with conn.begin_nested():
+            await conn.execute(text("ALTER TABLE foody_reservations ADD CONSTRAINT foody_reservations_offer_id_fkey FOREIGN KEY (offer_id) REFERENCES foody_offers(id)"))
+    except Exception:
+        log.warning("could not restore foody_reservations.offer_id foreign key", exc_info=True)
+
+_MIGRATION_LOCK_KEY = 0x466F6F6479  # "Foody"
+
+@app.on_event("startup")
+async def on_startup():
+    global pg_pool
+    if RUN_MIGRATIONS:
+        async with engine.begin() as conn:
+            if conn.dialect.name == "postgresql":
+                # Workers start together; serialize DDL so only the first one migrates, the rest see a no-op
+                await conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": _MIGRATION_LOCK_KEY})
+            await conn.run_sync(Base.metadata.create_all)
+            try:
+                await _auto_migrate(conn)
+            except Exception:
+                pass
+            if conn.dialect.name == "postgresql":
+                await _migrate_offer_ids_to_uuid(conn)
+    if DATABASE_URL.startswith("postgresql+asyncpg://"):
+        import asyncpg
+        pg_pool = await asyncpg.create_pool("postgresql://" + DATABASE_URL.split("://",1)[1], min_size=2, max_size=20)
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    if pg_pool is not None:
+        await pg_pool.close()
+
+@app.get("/health")
+async def health(): return {"ok": True}
 
 # --- Helpers ---
+async def get_db_session():
+    async with SessionLocal() as db:
+        yield db
+
+def foody_key(x_foody_key: Optional[str] = Header(None)) -> Optional[str]:
+    # Optional so that a missing key still gets our 401, not FastAPI's 422
+    return x_foody_key
+
 async def _auth_restaurant(db: AsyncSession, restaurant_id: str, api_key: Optional[str]):
     if not restaurant_id: raise HTTPException(400, "restaurant_id required")
     if not api_key: raise HTTPException(401, "Missing X-Foody-Key")
-    row = await db.execute(select(FoodyApiKey).where(FoodyApiKey.restaurant_id==restaurant_id))
-    row = row.scalar_one_or_none()
-    if not row or row.api_key != api_key: raise HTTPException(401, "Invalid X-Foody-Key")
-
-def _offer_dict(o: FoodyOffer):
-    tier, eff = price_tier_for_offer(o)
-    tl = max(0, int((o.expires_at - now_utc()).total_seconds()//60))
-    return {"id": o.id, "restaurant_id": o.restaurant_id, "title": o.title, "description": o.description,
-            "price_cents": o.price_cents, "original_price_cents": o.original_price_cents,
-            "price_cents_effective": eff, "tier": tier, "qty_total": o.qty_total, "qty_left": o.qty_left,
-            "expires_at": o.expires_at.isoformat(), "time_left_min": tl,
-            "archived_at": o.archived_at.isoformat() if o.archived_at else None, "created_at": o.created_at.isoformat()}
+    if _AUTH_CACHE.get(restaurant_id) == api_key: return
+    if pg_pool is not None:
+        stored = await pg_pool.fetchval("SELECT api_key FROM foody_api_keys WHERE restaurant_id=$1", restaurant_id)
+    else:
+        stored = (await db.execute(_AUTH_STMT, {"rid": restaurant_id})).scalar_one_or_none()
+    if not stored or stored != api_key: raise HTTPException(401, "Invalid X-Foody-Key")
+    _AUTH_CACHE.set(restaurant_id, stored)
+
+# Listing endpoints read these columns as plain mappings (no ORM hydration)
+_OFFER_COLS = tuple(FoodyOffer.__table__.c[name] for name in (
+    "id", "restaurant_id", "title", "description", "price_cents", "original_price_cents",
+    "qty_total", "qty_left", "expires_at", "archived_at", "created_at"))
+_OFFER_SQL_COLS = ", ".join(c.name for c in _OFFER_COLS)
+
+# Hot statements built once; per-request values go in as bind params
+_AUTH_STMT = lambda_stmt(lambda: select(FoodyApiKey.api_key).where(FoodyApiKey.restaurant_id==bindparam("rid")))
+
+_redeemed = FoodyReservation.status=="redeemed"
+_KPI_STMT = (select(func.count(),
+                    func.coalesce(func.sum(case((_redeemed, 1), else_=0)), 0),
+                    func.coalesce(func.sum(case((_redeemed, FoodyReservation.price_cents_effective), else_=0)), 0),
+                    func.coalesce(func.sum(case((and_(_redeemed, FoodyOffer.original_price_cents>FoodyReservation.price_cents_effective),
+                                                 FoodyOffer.original_price_cents - FoodyReservation.price_cents_effective), else_=0)), 0))
+             .select_from(FoodyReservation)
+             .outerjoin(FoodyOffer, FoodyOffer.id==FoodyReservation.offer_id)
+             .where(FoodyReservation.restaurant_id==bindparam("rid")))
+
+def _offer_dict_from_row(m, now: datetime):
+    left = (m["expires_at"] - now).total_seconds()
+    tier, eff = _price_tier(m["price_cents"], m["original_price_cents"], left)
+    tl = max(0, int(left//60))
+    # str(): raw asyncpg rows carry pgproto.UUID for native uuid ids, which orjson refuses
+    return {"id": str(m["id"]), "restaurant_id": m["restaurant_id"], "title": m["title"], "description": m["description"],
+            "price_cents": m["price_cents"], "original_price_cents": m["original_price_cents"],
+            "price_cents_effective": eff, "tier": tier, "qty_total": m["qty_total"], "qty_left": m["qty_left"],
+            "expires_at": m["expires_at"], "time_left_min": tl,
+            "archived_at": m["archived_at"], "created_at": m["created_at"]}
+
+def _offer_dict(o: FoodyOffer, now: datetime):
+    return _offer_dict_from_row({c.name: getattr(o, c.name) for c in _OFFER_COLS}, now)
 
 # --- Tiered discounts ---
-def price_tier_for_offer(o: "FoodyOffer"):
-    if not o.original_price_cents or o.original_price_cents <= 0:
-        return ("base", o.price_cents)
-    now = now_utc()
-    minutes = int((o.expires_at - now).total_seconds() // 60)
+def _price_tier(price_cents: int, original_price_cents: Optional[int], seconds_left: float):
+    if not original_price_cents or original_price_cents <= 0:
+        return ("base", price_cents)
+    minutes = int(seconds_left // 60)
     if minutes <= 30: disc = 0.70; label = "-70%"
     elif minutes <= 60: disc = 0.50; label = "-50%"
     elif minutes <= 120: disc = 0.30; label = "-30%"
-    else: return ("base", o.price_cents if o.price_cents else int(o.original_price_cents))
-    eff = int(round(o.original_price_cents * (1.0 - disc)))
+    else: return ("base", price_cents if price_cents else int(original_price_cents))
+    eff = int(round(original_price_cents * (1.0 - disc)))
     return (label, eff)
 
 # --- Public endpoints ---
 
 @app.post("/api/v1/merchant/register_public")
-async def register_public(body: dict):
+async def register_public(body: dict, db: AsyncSession = Depends(get_db_session)):
     title = (body.get("title") or "").strip()
     phone = (body.get("phone") or "").strip() or None
     if not title: raise HTTPException(400, "title required")
-    async with SessionLocal() as db:
-        r = FoodyRestaurant(title=title, phone=phone)
-        db.add(r); await db.flush()
-        key = FoodyApiKey(restaurant_id=r.id, api_key="KEY_" + uuid.uuid4().hex[:12])
-        db.add(key); await db.commit()
-        return {"restaurant_id": r.id, "api_key": key.api_key}
+    r = FoodyRestaurant(title=title, phone=phone)
+    db.add(r); await db.flush()
+    key = FoodyApiKey(restaurant_id=r.id, api_key="KEY_" + secrets.token_hex(6))
+    db.add(key); await db.commit()
+    _AUTH_CACHE.set(r.id, key.api_key)
+    return {"restaurant_id": r.id, "api_key": key.api_key}
 
 @app.get("/api/v1/offers")
 async def buyer_offers(restaurant_id: Optional[str] = None, limit: int = 100):
-    async with SessionLocal() as db:
-        stmt = select(FoodyOffer).where(FoodyOffer.archived_at.is_(None), FoodyOffer.qty_left>0, FoodyOffer.expires_at>now_utc())
+    cache_key = (restaurant_id, limit)
+    cached = _OFFERS_CACHE.get(cache_key)
+    if cached is not None: return Response(content=cached, media_type="application/json")
+    _now = now_utc()
+    if pg_pool is not None:
+        sql = f"SELECT {_OFFER_SQL_COLS} FROM foody_offers WHERE archived_at IS NULL AND qty_left > 0 AND expires_at > $1"
+        args = [_now]
         if restaurant_id:
-            stmt = stmt.where(FoodyOffer.restaurant_id == restaurant_id)
-        stmt = stmt.order_by(FoodyOffer.expires_at.asc()).limit(limit)
-        rows = (await db.execute(stmt)).scalars().all()
-        return [_offer_dict(o) for o in rows]
+            args.append(restaurant_id); sql += f" AND restaurant_id = ${len(args)}"
+        args.append(limit); sql += f" ORDER BY expires_at ASC LIMIT ${len(args)}"
+        rows = await pg_pool.fetch(sql, *args)
+    else:
+        async with SessionLocal() as db:
+            stmt = select(*_OFFER_COLS).where(FoodyOffer.archived_at.is_(None), FoodyOffer.qty_left>0, FoodyOffer.expires_at>_now)
+            if restaurant_id:
+                stmt = stmt.where(FoodyOffer.restaurant_id == restaurant_id)
+            stmt = stmt.order_by(FoodyOffer.expires_at.asc()).limit(limit)
+            rows = (await db.execute(stmt)).mappings().all()
+    # Return a Response so FastAPI skips jsonable_encoder; cache the encoded bytes.
+    # Without that pass every payload value must be orjson-native (str, int, datetime, exact uuid.UUID).
+    resp = ORJSONResponse([_offer_dict_from_row(m, _now) for m in rows])
+    _OFFERS_CACHE.set(cache_key, resp.body)
+    return resp
 
 
 # --- Merchant profile ---
 @app.get("/api/v1/merchant/profile")
-async def merchant_get_profile(request: Request, restaurant_id: str):
-    key = request.headers.get("X-Foody-Key")
-    async with SessionLocal() as db:
-        await _auth_restaurant(db, restaurant_id, key)
-        r = await db.get(FoodyRestaurant, restaurant_id)
-        if not r: raise HTTPException(404, "Restaurant not found")
-        return {"id": r.id, "title": r.title, "phone": r.phone}
+async def merchant_get_profile(restaurant_id: str, key: Optional[str] = Depends(foody_key), db: AsyncSession = Depends(get_db_session)):
+    await _auth_restaurant(db, restaurant_id, key)
+    r = await db.get(FoodyRestaurant, restaurant_id)
+    if not r: raise HTTPException(404, "Restaurant not found")
+    return {"id": r.id, "title": r.title, "phone": r.phone}
 
 @app.post("/api/v1/merchant/profile")
-async def merchant_update_profile(request: Request, body: dict):
+async def merchant_update_profile(body: dict, key: Optional[str] = Depends(foody_key), db: AsyncSession = Depends(get_db_session)):
     restaurant_id = body.get("restaurant_id")
-    key = request.headers.get("X-Foody-Key")
-    async with SessionLocal() as db:
-        await _auth_restaurant(db, restaurant_id, key)
-        r = await db.get(FoodyRestaurant, restaurant_id)
-        if not r: raise HTTPException(404, "Restaurant not found")
-        title = (body.get("title") or "").strip()
-        phone = (body.get("phone") or "").strip() or None
-        if title: r.title = title
-        r.phone = phone
-        await db.commit(); await db.refresh(r)
-        return {"id": r.id, "title": r.title, "phone": r.phone}
+    await _auth_restaurant(db, restaurant_id, key)
+    r = await db.get(FoodyRestaurant, restaurant_id)
+    if not r: raise HTTPException(404, "Restaurant not found")
+    title = (body.get("title") or "").strip()
+    phone = (body.get("phone") or "").strip() or None
+    if title: r.title = title
+    r.phone = phone
+    await db.commit(); await db.refresh(r)
+    return {"id": r.id, "title": r.title, "phone": r.phone}
 
 # --- Merchant endpoints ---
 @app.get("/api/v1/merchant/offers")
-async def merchant_list_offers(request: Request, restaurant_id: str, status: str = Query("active", enum=["active","archived","all"])):
-    key = request.headers.get("X-Foody-Key")
-    async with SessionLocal() as db:
-        await _auth_restaurant(db, restaurant_id, key)
-        stmt = select(FoodyOffer).where(FoodyOffer.restaurant_id==restaurant_id)
+async def merchant_list_offers(restaurant_id: str, status: str = Query("active", enum=["active","archived","all"]),
+                               limit: Optional[int] = Query(None, ge=1, le=500), before: Optional[str] = None, key: Optional[str] = Depends(foody_key), db: AsyncSession = Depends(get_db_session)):
+    # Newest first, unlimited by default; with `limit`, pass the last item's created_at as `before` for the next page
+    cursor = None
+    if before:
+        try:
+            cursor = datetime.fromisoformat(before)
+        except ValueError:
+            raise HTTPException(400, "invalid before")
+        cursor = cursor.replace(tzinfo=timezone.utc) if cursor.tzinfo is None else cursor.astimezone(timezone.utc)
+    await _auth_restaurant(db, restaurant_id, key)
+    if pg_pool is not None:
+        sql = f"SELECT {_OFFER_SQL_COLS} FROM foody_offers WHERE restaurant_id = $1"
+        args = [restaurant_id]
+        if status=="active":
+            sql += " AND archived_at IS NULL"
+        elif status=="archived":
+            sql += " AND archived_at IS NOT NULL"
+        if cursor:
+            args.append(cursor); sql += f" AND created_at < ${len(args)}"
+        sql += " ORDER BY created_at DESC"
+        if limit is not None:
+            args.append(limit); sql += f" LIMIT ${len(args)}"
+        rows = await pg_pool.fetch(sql, *args)
+    else:
+        stmt = select(*_OFFER_COLS).where(FoodyOffer.restaurant_id==restaurant_id)
         if status=="active":
             stmt = stmt.where(FoodyOffer.archived_at.is_(None))
         elif status=="archived":
             stmt = stmt.where(FoodyOffer.archived_at.is_not(None))
-        rows = (await db.execute(stmt)).scalars().all()
-        return [_offer_dict(o) for o in rows]
-
-@app.post("/api/v1/merchant/offers")
-async def merchant_create_offer(request: Request, body: dict):
-    restaurant_id = body.get("restaurant_id")
-    key = request.headers.get("X-Foody-Key")
-    async with SessionLocal() as db:
-        await _auth_restaurant(db, restaurant_id, key)
-        o = FoodyOffer(
-            restaurant_id=restaurant_id,
+        if cursor:
+            stmt = stmt.where(FoodyOffer.created_at < cursor)
+        stmt = stmt.order_by(FoodyOffer.created_at.desc())
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        rows = (await db.execute(stmt)).mappings().all()
+    _now = now_utc()
+    return ORJSONResponse([_offer_dict_from_row(m, _now) for m in rows])
+
+_BULK_MAX = 500
+
+def _offer_fields(body: dict) -> dict:
+    if not isinstance(body, dict): raise HTTPException(400,"invalid offer")
+    try:
+        f = dict(
             title=(body.get("title") or "").strip(),
             description=(body.get("description") or None),
             price_cents=int(body.get("price_cents") or 0),
@@ -223,132 +432,187 @@ async def merchant_create_offer(request: Request, body: dict):
             qty_left=int(body.get("qty_left") or body.get("qty_total") or 1),
             expires_at=datetime.fromisoformat(body.get("expires_at")).astimezone(timezone.utc),
         )
-        if not o.title or o.price_cents<=0: raise HTTPException(400,"invalid offer")
-        db.add(o); await db.commit(); await db.refresh(o)
-        return _offer_dict(o)
+    except (ValueError, TypeError, AttributeError):
+        raise HTTPException(400,"invalid offer")
+    if not f["title"] or f["price_cents"]<=0: raise HTTPException(400,"invalid offer")
+    return f
+
+@app.post("/api/v1/merchant/offers")
+async def merchant_create_offer(body: dict, key: Optional[str] = Depends(foody_key), db: AsyncSession = Depends(get_db_session)):
+    restaurant_id = body.get("restaurant_id")
+    await _auth_restaurant(db, restaurant_id, key)
+    o = FoodyOffer(restaurant_id=restaurant_id, **_offer_fields(body))
+    db.add(o); await db.commit(); await db.refresh(o)
+    _OFFERS_CACHE.clear()
+    return _offer_dict(o, now_utc())
+
+@app.post("/api/v1/merchant/offers/bulk")
+async def merchant_create_offers_bulk(body: dict, key: Optional[str] = Depends(foody_key), db: AsyncSession = Depends(get_db_session)):
+    restaurant_id = body.get("restaurant_id")
+    items = body.get("offers")
+    await _auth_restaurant(db, restaurant_id, key)
+    if not isinstance(items, list) or not items: raise HTTPException(400, "offers required")
+    if len(items) > _BULK_MAX: raise HTTPException(400, f"at most {_BULK_MAX} offers per request")
+    rows = [dict(_offer_fields(x), restaurant_id=restaurant_id) for x in items]
+    # one multi-row INSERT per batch instead of a round-trip per offer; ids come back in `offers` order
+    ids = (await db.execute(insert(FoodyOffer).returning(FoodyOffer.id, sort_by_parameter_order=True), rows)).scalars().all()
+    await db.commit()
+    _OFFERS_CACHE.clear()
+    return {"ok": True, "created": len(ids), "ids": ids}
 
 @app.patch("/api/v1/merchant/offers/{offer_id}")
-async def merchant_patch_offer(offer_id: str, request: Request, body: dict):
+async def merchant_patch_offer(offer_id: str, body: dict, key: Optional[str] = Depends(foody_key), db: AsyncSession = Depends(get_db_session)):
     restaurant_id = body.get("restaurant_id")
-    key = request.headers.get("X-Foody-Key")
-    async with SessionLocal() as db:
-        await _auth_restaurant(db, restaurant_id, key)
-        o = await db.get(FoodyOffer, offer_id)
-        if not o or o.restaurant_id!=restaurant_id: raise HTTPException(404,"Offer not found")
-        for k in ["title","description","price_cents","original_price_cents","qty_total","qty_left","expires_at"]:
-            if k in body and body[k] is not None:
-                if k.endswith("_cents") or k.startswith("qty"):
-                    setattr(o,k,int(body[k]))
-                elif k=="expires_at":
-                    setattr(o,k, _parse_client_datetime(body[k]))
-                else:
-                    setattr(o,k, body[k])
-        await db.commit(); await db.refresh(o)
-        return _offer_dict(o)
+    await _auth_restaurant(db, restaurant_id, key)
+    if not _is_uuid(offer_id): raise HTTPException(404,"Offer not found")
+    o = await db.get(FoodyOffer, offer_id)
+    if not o or o.restaurant_id!=restaurant_id: raise HTTPException(404,"Offer not found")
+    for k in ["title","description","price_cents","original_price_cents","qty_total","qty_left","expires_at"]:
+        if k in body and body[k] is not None:
+            if k.endswith("_cents") or k.startswith("qty"):
+                setattr(o,k,int(body[k]))
+            elif k=="expires_at":
+                setattr(o,k, _parse_client_datetime(body[k]))
+            else:
+                setattr(o,k, body[k])
+    await db.commit(); await db.refresh(o)
+    _OFFERS_CACHE.clear()
+    return _offer_dict(o, now_utc())
+
+def _key_guard(stmt, restaurant_id: str, api_key: str):
+    # Fold the API key check into a write; skipped when the key is already cached
+    if _AUTH_CACHE.get(restaurant_id) == api_key: return stmt
+    return stmt.where(exists().where(FoodyApiKey.restaurant_id==restaurant_id, FoodyApiKey.api_key==api_key))
+
+async def _update_own_offer(db: AsyncSession, offer_id: str, restaurant_id: str, api_key: Optional[str], **values):
+    if restaurant_id and api_key and _is_uuid(offer_id):
+        stmt = update(FoodyOffer).where(FoodyOffer.id==offer_id, FoodyOffer.restaurant_id==restaurant_id)
+        stmt = _key_guard(stmt, restaurant_id, api_key).values(**values).returning(FoodyOffer.id)
+        if (await db.execute(stmt)).first() is not None:
+            await db.commit()
+            _AUTH_CACHE.set(restaurant_id, api_key)
+            _OFFERS_CACHE.clear()
+            return
+    # Nothing updated: spend the extra lookup only to tell 401 from 404
+    await _auth_restaurant(db, restaurant_id, api_key)
+    raise HTTPException(404,"Offer not found")
 
 @app.delete("/api/v1/merchant/offers/{offer_id}")
-async def merchant_archive_offer(offer_id: str, request: Request, restaurant_id: str):
-    key = request.headers.get("X-Foody-Key")
-    async with SessionLocal() as db:
-        await _auth_restaurant(db, restaurant_id, key)
-        o = await db.get(FoodyOffer, offer_id)
-        if not o or o.restaurant_id!=restaurant_id: raise HTTPException(404,"Offer not found")
-        o.archived_at = now_utc()
-        await db.commit()
-        return {"ok": True, "archived_id": offer_id}
+async def merchant_archive_offer(offer_id: str, restaurant_id: str, key: Optional[str] = Depends(foody_key), db: AsyncSession = Depends(get_db_session)):
+    await _update_own_offer(db, offer_id, restaurant_id, key, archived_at=now_utc())
+    return {"ok": True, "archived_id": offer_id}
 
 @app.post("/api/v1/merchant/offers/{offer_id}/restore")
-async def merchant_restore_offer(offer_id: str, request: Request, restaurant_id: str):
-    key = request.headers.get("X-Foody-Key")
-    async with SessionLocal() as db:
-        await _auth_restaurant(db, restaurant_id, key)
-        o = await db.get(FoodyOffer, offer_id)
-        if not o or o.restaurant_id!=restaurant_id: raise HTTPException(404,"Offer not found")
-        o.archived_at = None
-        await db.commit()
-        return {"ok": True, "restored_id": offer_id}
-
-@app.get("/api/v1/merchant/export.csv", response_class=PlainTextResponse)
-async def merchant_export_csv(request: Request, restaurant_id: str):
-    key = request.headers.get("X-Foody-Key")
-    async with SessionLocal() as db:
-        await _auth_restaurant(db, restaurant_id, key)
-        stmt = select(FoodyOffer).where(FoodyOffer.restaurant_id==restaurant_id).order_by(FoodyOffer.created_at.desc())
-        rows = (await db.execute(stmt)).scalars().all()
+async def merchant_restore_offer(offer_id: str, restaurant_id: str, key: Optional[str] = Depends(foody_key), db: AsyncSession = Depends(get_db_session)):
+    await _update_own_offer(db, offer_id, restaurant_id, key, archived_at=None)
+    return {"ok": True, "restored_id": offer_id}
+
+_CSV_COLS = ("id","title","price_cents","original_price_cents","qty_total","qty_left","expires_at","archived_at","created_at")
+
+@app.get("/api/v1/merchant/export.csv", responses={200: {"content": {"text/csv": {}}}})
+async def merchant_export_csv(restaurant_id: str, key: Optional[str] = Depends(foody_key), db: AsyncSession = Depends(get_db_session)):
+    await _auth_restaurant(db, restaurant_id, key)
+
+    async def gen():
+        # Emit one chunk per fetched batch so memory stays flat for large menus
         buf = io.StringIO()
         w = csv.writer(buf)
-        w.writerow(["id","title","price_cents","original_price_cents","qty_total","qty_left","expires_at","archived_at","created_at"])
-        for o in rows:
-            w.writerow([o.id,o.title,o.price_cents,o.original_price_cents or "",o.qty_total,o.qty_left,o.expires_at.isoformat(),o.archived_at.isoformat() if o.archived_at else "",o.created_at.isoformat()])
-        buf.seek(0)
-        return PlainTextResponse(buf.read(), media_type="text/csv")
+        w.writerow(_CSV_COLS)
+        yield buf.getvalue()
+        # own session: the request-scoped `db` is closed before the body is sent
+        async with SessionLocal() as stream_db:
+            stmt = (select(*(FoodyOffer.__table__.c[name] for name in _CSV_COLS))
+                    .where(FoodyOffer.restaurant_id==restaurant_id)
+                    .order_by(FoodyOffer.created_at.desc())
+                    .execution_options(yield_per=1000))
+            result = await stream_db.stream(stmt)
+            async for batch in result.partitions():
+                buf.seek(0); buf.truncate(0)
+                for o in batch:
+                    w.writerow([o.id,o.title,o.price_cents,o.original_price_cents or "",o.qty_total,o.qty_left,o.expires_at.isoformat(),o.archived_at.isoformat() if o.archived_at else "",o.created_at.isoformat()])
+                yield buf.getvalue()
+
+    return StreamingResponse(gen(), media_type="text/csv")
 
 @app.post("/api/v1/buyer/reserve")
-async def buyer_reserve(body: dict):
+async def buyer_reserve(body: dict, db: AsyncSession = Depends(get_db_session)):
     offer_id = (body.get("offer_id") or "").strip()
     if not offer_id: raise HTTPException(400, "offer_id required")
-    async with SessionLocal() as db:
+    if not _is_uuid(offer_id): raise HTTPException(404, "offer not found")
+    _now = now_utc()
+    # Claim one unit atomically; concurrent reservations cannot oversell
+    stmt = (update(FoodyOffer)
+            .where(FoodyOffer.id==offer_id, FoodyOffer.qty_left>0, FoodyOffer.archived_at.is_(None), FoodyOffer.expires_at>_now)
+            .values(qty_left=FoodyOffer.qty_left - 1)
+            .returning(FoodyOffer))
+    o = (await db.execute(stmt)).scalar_one_or_none()
+    if o is None:
         o = await db.get(FoodyOffer, offer_id)
         if not o or o.archived_at is not None: raise HTTPException(404, "offer not found")
-        if o.qty_left <= 0 or o.expires_at <= now_utc(): raise HTTPException(400, "offer not available")
-        tier, eff = price_tier_for_offer(o)
-        o.qty_left = max(0, o.qty_left - 1)
-        code_val = "QR_" + uuid.uuid4().hex[:10].upper()
-        rsv = FoodyReservation(offer_id=o.id, restaurant_id=o.restaurant_id, code=code_val, qty=1,
-                               price_cents_effective=eff, expires_at=min(o.expires_at, now_utc().replace(microsecond=0) + timedelta(minutes=30)))
-        db.add(rsv); await db.commit(); await db.refresh(rsv); await db.refresh(o)
-        return {"reservation_id": rsv.id, "code": rsv.code, "status": rsv.status, "expires_at": rsv.expires_at.isoformat(), "offer": _offer_dict(o)}
+        raise HTTPException(400, "offer not available")
+    tier, eff = _price_tier(o.price_cents, o.original_price_cents, (o.expires_at - _now).total_seconds())
+    code_val = "QR_" + secrets.token_hex(5).upper()
+    rsv = FoodyReservation(offer_id=o.id, restaurant_id=o.restaurant_id, code=code_val, qty=1,
+                           price_cents_effective=eff, expires_at=min(o.expires_at, _now.replace(microsecond=0) + timedelta(minutes=30)))
+    db.add(rsv); await db.commit()
+    _OFFERS_CACHE.clear()
+    _QR_CACHE.set(code_val, await asyncio.to_thread(_render_qr, code_val))
+    return {"reservation_id": rsv.id, "code": rsv.code, "status": rsv.status, "expires_at": rsv.expires_at, "offer": _offer_dict(o, _now)}
 @app.post("/api/v1/merchant/redeem")
-async def merchant_redeem(request: Request, body: dict):
+async def merchant_redeem(body: dict, key: Optional[str] = Depends(foody_key), db: AsyncSession = Depends(get_db_session)):
     restaurant_id = (body.get("restaurant_id") or "").strip()
     code_val = (body.get("code") or "").strip()
-    key = request.headers.get("X-Foody-Key")
-    async with SessionLocal() as db:
-        await _auth_restaurant(db, restaurant_id, key)
-        stmt = select(FoodyReservation).where(FoodyReservation.code==code_val)
-        rsv = (await db.execute(stmt)).scalar_one_or_none()
-        if not rsv: raise HTTPException(404, "reservation not found")
-        if rsv.restaurant_id != restaurant_id: raise HTTPException(403, "foreign reservation")
-        if rsv.status != "reserved": raise HTTPException(400, "already processed")
-        if rsv.expires_at <= now_utc(): 
-            rsv.status = "expired"; await db.commit(); raise HTTPException(400, "reservation expired")
-        rsv.status = "redeemed"; rsv.redeemed_at = now_utc()
-        await db.commit(); await db.refresh(rsv)
-        return {"ok": True, "reservation_id": rsv.id, "redeemed_at": rsv.redeemed_at.isoformat()}
+    _now = now_utc()
+    if restaurant_id and key and code_val:
+        stmt = update(FoodyReservation).where(FoodyReservation.code==code_val, FoodyReservation.restaurant_id==restaurant_id,
+                                              FoodyReservation.status=="reserved", FoodyReservation.expires_at>_now)
+        stmt = _key_guard(stmt, restaurant_id, key).values(status="redeemed", redeemed_at=_now)
+        row = (await db.execute(stmt.returning(FoodyReservation.id, FoodyReservation.redeemed_at))).first()
+        if row is not None:
+            await db.commit()
+            _AUTH_CACHE.set(restaurant_id, key)
+            return {"ok": True, "reservation_id": row.id, "redeemed_at": row.redeemed_at}
+    # Slow path: nothing redeemed, find out why
+    await _auth_restaurant(db, restaurant_id, key)
+    stmt = select(FoodyReservation).where(FoodyReservation.code==code_val)
+    rsv = (await db.execute(stmt)).scalar_one_or_none()
+    if not rsv: raise HTTPException(404, "reservation not found")
+    if rsv.restaurant_id != restaurant_id: raise HTTPException(403, "foreign reservation")
+    if rsv.status != "reserved": raise HTTPException(400, "already processed")
+    if rsv.expires_at <= now_utc(): 
+        rsv.status = "expired"; await db.commit(); raise HTTPException(400, "reservation expired")
+    rsv.status = "redeemed"; rsv.redeemed_at = now_utc()
+    await db.commit(); await db.refresh(rsv)
+    return {"ok": True, "reservation_id": rsv.id, "redeemed_at": rsv.redeemed_at}
 @app.get("/api/v1/merchant/reservations")
-async def merchant_reservations(request: Request, restaurant_id: str, limit: int = 100):
-    key = request.headers.get("X-Foody-Key")
-    async with SessionLocal() as db:
-        await _auth_restaurant(db, restaurant_id, key)
-        stmt = select(FoodyReservation).where(FoodyReservation.restaurant_id==restaurant_id).order_by(FoodyReservation.created_at.desc()).limit(limit)
-        rows = (await db.execute(stmt)).scalars().all()
-        def row(x: FoodyReservation):
-            return {"id": x.id, "code": x.code, "status": x.status, "price_cents_effective": x.price_cents_effective,
-                    "created_at": x.created_at.isoformat(), "redeemed_at": x.redeemed_at.isoformat() if x.redeemed_at else None,
-                    "expires_at": x.expires_at.isoformat(), "offer_id": x.offer_id}
-        return [row(x) for x in rows]
+async def merchant_reservations(restaurant_id: str, limit: int = 100, key: Optional[str] = Depends(foody_key), db: AsyncSession = Depends(get_db_session)):
+    await _auth_restaurant(db, restaurant_id, key)
+    stmt = select(FoodyReservation).where(FoodyReservation.restaurant_id==restaurant_id).order_by(FoodyReservation.created_at.desc()).limit(limit)
+    rows = (await db.execute(stmt)).scalars().all()
+    def row(x: FoodyReservation):
+        return {"id": x.id, "code": x.code, "status": x.status, "price_cents_effective": x.price_cents_effective,
+                "created_at": x.created_at, "redeemed_at": x.redeemed_at,
+                "expires_at": x.expires_at, "offer_id": x.offer_id}
+    return ORJSONResponse([row(x) for x in rows])
 @app.get("/api/v1/merchant/kpi")
-async def merchant_kpi(request: Request, restaurant_id: str):
-    key = request.headers.get("X-Foody-Key")
-    async with SessionLocal() as db:
-        await _auth_restaurant(db, restaurant_id, key)
-        total_reserved = (await db.execute(select(func.count()).select_from(FoodyReservation).where(FoodyReservation.restaurant_id==restaurant_id))).scalar_one()
-        total_redeemed = (await db.execute(select(func.count()).select_from(FoodyReservation).where(FoodyReservation.restaurant_id==restaurant_id, FoodyReservation.status=="redeemed"))).scalar_one()
-        revenue = (await db.execute(select(func.coalesce(func.sum(FoodyReservation.price_cents_effective),0)).where(FoodyReservation.restaurant_id==restaurant_id, FoodyReservation.status=="redeemed"))).scalar_one()
-        stmt = select(FoodyReservation.price_cents_effective, FoodyOffer.original_price_cents).join(FoodyOffer, FoodyOffer.id==FoodyReservation.offer_id).where(FoodyReservation.restaurant_id==restaurant_id, FoodyReservation.status=="redeemed")
-        rows = (await db.execute(stmt)).all()
-        saved = 0
-        for eff, orig in rows:
-            if orig and orig>0 and eff is not None:
-                saved += max(0, orig - eff)
-        rate = (total_redeemed/total_reserved) if total_reserved else 0.0
-        return {"reserved": int(total_reserved), "redeemed": int(total_redeemed), "redemption_rate": round(rate,3), "revenue_cents": int(revenue), "saved_cents": int(saved)}
-
-from fastapi.responses import Response
-@app.get("/api/v1/qr/{code}.png")
-async def qr_png(code: str):
-    import qrcode, io as _io
+async def merchant_kpi(restaurant_id: str, key: Optional[str] = Depends(foody_key), db: AsyncSession = Depends(get_db_session)):
+    await _auth_restaurant(db, restaurant_id, key)
+    total_reserved, total_redeemed, revenue, saved = (await db.execute(_KPI_STMT, {"rid": restaurant_id})).one()
+    rate = (total_redeemed/total_reserved) if total_reserved else 0.0
+    return {"reserved": int(total_reserved), "redeemed": int(total_redeemed), "redemption_rate": round(rate,3), "revenue_cents": int(revenue), "saved_cents": int(saved)}
+
+def _render_qr(code: str) -> bytes:
+    # CPU-bound (Reed-Solomon + PNG encode): always call via asyncio.to_thread
+    import qrcode
     img = qrcode.make(code)
-    buf = _io.BytesIO()
+    buf = io.BytesIO()
     img.save(buf, format="PNG")
-    return Response(content=buf.getvalue(), media_type="image/png")
+    return buf.getvalue()
+
+@app.get("/api/v1/qr/{code}.png")
+async def qr_png(code: str):
+    data = _QR_CACHE.get(code)
+    if data is None:
+        # unauthenticated input: render on demand but never cache, only buyer_reserve fills _QR_CACHE
+        data = await asyncio.to_thread(_render_qr, code)
+    return Response(content=data, media_type="image/png")
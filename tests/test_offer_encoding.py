@@ -0,0 +1,18 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from asyncpg.pgproto import pgproto
+from fastapi.responses import ORJSONResponse
+
+from backend.main import _offer_dict_from_row
+
+
+def test_asyncpg_offer_row_encodes_as_json():
+    # Shape of a raw asyncpg Record for foody_offers once id is a native uuid column
+    now = datetime.now(timezone.utc)
+    oid = str(uuid.uuid4())
+    row = {"id": pgproto.UUID(oid), "restaurant_id": "RID_00000000", "title": "Bun", "description": None,
+           "price_cents": 100, "original_price_cents": 300, "qty_total": 2, "qty_left": 1,
+           "expires_at": now + timedelta(minutes=45), "archived_at": None, "created_at": now}
+    body = ORJSONResponse([_offer_dict_from_row(row, now)]).body
+    assert f'"id":"{oid}"'.encode() in body